@@ -44,6 +44,13 @@ def code(dtype):
     raise ValueError(dtype)
 
 
+def best_fitting_dtype(vocab_size=None):
+    if vocab_size is not None and vocab_size < 65500:
+        return np.uint16
+    else:
+        return np.int32
+
+
 def index_file_path(prefix_path):
     return prefix_path + ".idx"
 
@@ -11,6 +11,7 @@ from tqdm import tqdm
 from pytorch_lightning.utilities import rank_zero_info
 from binidx import MMapIndexedDataset
 from utils import MaybeIsPrime
+from tokenizer import load_json
 
 
 class MIDIDataset(Dataset):
@@ -25,23 +26,23 @@ class MIDIDataset(Dataset):
         token_ids = []
         tokens = None
 
-        for file_path in tqdm(files_paths, desc=f'Loading data: {files_paths[0].parent}'):
-            with open(file_path) as json_file:
-                ids = json.load(json_file)['ids']
-                tokens = ids[0] if isinstance(
-                    ids[0], list) else ids  # first track (REMI, MMM)
-                token_ids += tokens
+        for file_path in tqdm(files_paths, desc=f'Loading data: {files_paths[0].parent}',
+                              mininterval=1.0, miniters=max(1, len(files_paths) // 1000)):
+            ids = load_json(file_path)['ids']
+            tokens = ids[0] if isinstance(
+                ids[0], list) else ids  # first track (REMI, MMM)
+            token_ids += tokens
 
-                i = 0
-                while i < len(tokens):
-                    if i >= len(tokens) - min_seq_len:
-                        break  # last sample is too short
+            i = 0
+            while i < len(tokens):
+                if i >= len(tokens) - min_seq_len:
+                    break  # last sample is too short
 
-                    sample = LongTensor(tokens[i:i + max_seq_len])
+                sample = LongTensor(tokens[i:i + max_seq_len])
 
-                    self.samples.append(sample)
+                self.samples.append(sample)
 
-                    i += len(self.samples[-1])  # could be replaced with self.ctx_len
+                i += len(self.samples[-1])  # could be replaced with self.ctx_len
 
         self.data = token_ids
         self.data_size = len(self.data)
@@ -43,29 +43,36 @@ import ray
 import psutil
 import gc
 import random
-from asyncio import Event
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from symusic import Score
-from ray.actor import ActorHandle
 from itertools import chain
 from loguru import logger
-from typing import Tuple
 from pathlib import Path
-from miditok import REMI, MMM
-from miditok.constants import BEAT_RES, INSTRUMENT_CLASSES, CHORD_MAPS
+from miditok import REMI, MMM, TokSequence
+from miditok.constants import BEAT_RES, INSTRUMENT_CLASSES, CHORD_MAPS, CHR_ID_START
 from miditok.classes import TokenizerConfig
 from miditok.utils import merge_tracks_per_class, merge_same_program_tracks, get_score_programs
-from miditoolkit import MidiFile
 from tqdm import tqdm
 from functools import reduce
 from operator import iconcat
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # initialize variables
 os.environ['FUNCTION_SIZE_ERROR_THRESHOLD'] = '512'
+TOKENIZERS_PARALLELISM_SET = 'TOKENIZERS_PARALLELISM' in os.environ
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
 
 TOKENS_PATH = '/home/nico/data/ai/models/midi/mix'
 MIDIS_PATH = '/home/nico/data/midis/MIDI'
 TOKEN_PARAMS_NAME = 'token_params.cfg'
 TOKEN_PARAMS_PATH = Path(f'{TOKENS_PATH}/{TOKEN_PARAMS_NAME}')
+BINIDX_NAME = 'tokens'
 
 PITCH_RANGE = range(21, 109)
 CLASSES_PERCUSSION = [1, 14, 16]
@@ -74,92 +81,22 @@ CLASSES_STRINGS = [5, 6]
 CLASSES_GUITAR_BASS = [3, 4]
 CLASS_REED = [8, 9]
 CLASS_EFFECTS = [12, 15]
+CLASSES_MERGED = CLASSES_PERCUSSION + CLASSES_SYNTHS + \
+    CLASSES_STRINGS + CLASSES_GUITAR_BASS
+CLASS_PROGRAMS = [frozenset(ic['program_range']) for ic in INSTRUMENT_CLASSES]
+EFFECTS_PROGRAMS = frozenset(chain.from_iterable(
+    CLASS_PROGRAMS[ic] for ic in CLASS_EFFECTS))
 BINS_VELOCITY = (24)
 BINS_TEMPO = (24)
+REQUIRED_TICKS = max(BEAT_RES.values()) * 4
+MIDI_NAME_RE = re.compile(r'[^0-9a-z_]+')
 
 TOKENIZER_ALGOS = ['REMI', 'MMM']
-
-# declare Ray related stuff
-
-
-@ray.remote
-class ProgressBarActor:
-    counter: int
-    delta: int
-    event: Event
-
-    def __init__(self) -> None:
-        self.counter = 0
-        self.delta = 0
-        self.event = Event()
-
-    def update(self, num_items_completed: int) -> None:
-        """Updates the ProgressBar with the incremental
-        number of items that were just completed.
-        """
-        self.counter += num_items_completed
-        self.delta += num_items_completed
-        self.event.set()
-
-    async def wait_for_update(self) -> Tuple[int, int]:
-        """Blocking call.
-
-        Waits until somebody calls `update`, then returns a tuple of
-        the number of updates since the last call to
-        `wait_for_update`, and the total number of completed items.
-        """
-        await self.event.wait()
-        self.event.clear()
-        saved_delta = self.delta
-        self.delta = 0
-        return saved_delta, self.counter
-
-    def get_counter(self) -> int:
-        """
-        Returns the total number of complete items.
-        """
-        return self.counter
-# Back on the local node, once you launch your remote Ray tasks, call
-# `print_until_done`, which will feed everything back into a `tqdm` counter.
-
-
-class ProgressBar:
-    progress_actor: ActorHandle
-    total: int
-    description: str
-    pbar: tqdm
-
-    def __init__(self, total: int, description: str = ""):
-        # Ray actors don't seem to play nice with mypy, generating
-        # a spurious warning for the following line,
-        # which we need to suppress. The code is fine.
-        self.progress_actor = ProgressBarActor.remote()  # type: ignore
-        self.total = total
-        self.description = description
-
-    @property
-    def actor(self) -> ActorHandle:
-        """Returns a reference to the remote `ProgressBarActor`.
-
-        When you complete tasks, call `update` on the actor.
-        """
-        return self.progress_actor
-
-    def print_until_done(self) -> None:
-        """Blocking call.
-
-        Do this after starting a series of remote Ray tasks, to which you've
-        passed the actor handle. Each of them calls `update` on the actor.
-        When the progress meter reaches 100%, this method returns.
-        """
-        pbar = tqdm(desc=self.description, total=self.total)
-        while True:
-            delta, counter = ray.get(self.actor.wait_for_update.remote())
-            pbar.update(delta)
-            if counter >= self.total:
-                pbar.close()
-                return
-
+CHUNKS_PER_WORKER = 4
+STREAM_CHUNK_SIZE = 64
+PENDING_PER_WORKER = 4
+READ_THREADS = 8
+READ_AHEAD = READ_THREADS * 2
 
 # initialize logger
 logger.add('tokenizer_errors_{time}.log', delay=True,
@@ -183,6 +120,8 @@ if __name__ == "__main__":
                             help='The glob pattern used to locate MIDI files', type=str)
     arg_parser.add_argument('-b', '--bpe', help='Applies BPE to the corpora of tokens',
                             action='store_true', default=False)
+    arg_parser.add_argument('-x', '--binidx', help='Also exports the final JSON tokens as a binidx dataset',
+                            action='store_true', default=False)
     arg_parser.add_argument('-p', '--preload', help='Absolute path to existing token_params.cfg settings',
                             default='token_params.cfg', type=str)
     arg_parser.add_argument('-a', '--algo', help='Tokenization algorithm',
@@ -195,6 +134,8 @@ if __name__ == "__main__":
                             default=16, type=int)
     arg_parser.add_argument('-n', '--num_limit', help='Limit number of files to process (random selection)',
                             default=None, type=int)
+    arg_parser.add_argument('-w', '--workers', help='Number of CPUs used by Ray (defaults to all)',
+                            default=psutil.cpu_count(), type=int)
     arg_parser.add_argument(
         '-d', '--debug', help='Debug mode.', action='store_true', default=False)
     args = arg_parser.parse_args()
@@ -218,6 +159,27 @@ def auto_garbage_collect(pct=80.0):
     return
 
 
+def load_json(path):
+    """Loads a JSON file, parsing it with orjson when available."""
+    if orjson is not None:
+        with open(path, 'rb') as json_file:
+            return orjson.loads(json_file.read())
+
+    with open(path) as json_file:
+        return json.load(json_file)
+
+
+def save_json(obj, path):
+    """Saves an object as JSON, serializing it with orjson when available."""
+    if orjson is not None:
+        with open(path, 'wb') as json_file:
+            json_file.write(orjson.dumps(
+                obj, option=orjson.OPT_SERIALIZE_NUMPY))
+    else:
+        with open(path, 'w') as json_file:
+            json.dump(obj, json_file)
+
+
 def to_iterator(obj_ids, debug=False):
     if debug:
         return obj_ids
@@ -227,9 +189,31 @@ def to_iterator(obj_ids, debug=False):
         yield ray.get(done[0])
 
 
+def to_bounded_iterator(obj_ids, max_pending, debug=False):
+    """Consumes a lazy iterable of Ray tasks, keeping at most `max_pending` of them in flight.
+
+    Tasks are only submitted when a slot frees up and their results are yielded as soon
+    as they are ready, so the object store never holds more than a few of them.
+    """
+    if debug:
+        yield from obj_ids
+        return
+
+    pending = []
+
+    for obj_id in obj_ids:
+        pending.append(obj_id)
+
+        if len(pending) >= max_pending:
+            done, pending = ray.wait(pending)
+            yield ray.get(done[0])
+
+    yield from to_iterator(pending)
+
+
 def filter_programs(skip_programs):
     all_programs = range(-1, 128)
-    keep_programs = list(set(all_programs) - set(skip_programs))
+    keep_programs = set(all_programs) - set(skip_programs)
 
     return keep_programs
 
@@ -237,22 +221,150 @@ def filter_programs(skip_programs):
 def get_other_programs(classes):
     programs = []
 
-    for i in range(0, len(INSTRUMENT_CLASSES)):
+    for i in range(0, len(CLASS_PROGRAMS)):
         if i not in classes:
-            programs += list(
-                INSTRUMENT_CLASSES[i]['program_range'])
+            programs += CLASS_PROGRAMS[i]
 
     return programs
 
 
+def get_chunks(items, workers=1):
+    """Splits a list of items in chunks, a few per worker."""
+    chunk_size = max(1, len(items) // (max(1, workers) * CHUNKS_PER_WORKER))
+
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def iter_chunks(items, chunk_size=STREAM_CHUNK_SIZE):
+    """Lazily groups the items of an iterable in chunks of `chunk_size`."""
+    chunk = []
+
+    for item in items:
+        chunk.append(item)
+
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def iter_midi_paths(midis_path, midis_glob=None):
+    """Lazily yields MIDI paths from a folder or from a file containing a list of paths."""
+    if os.path.isfile(midis_path):
+        with open(midis_path) as paths_file:
+            for line in paths_file:
+                if line.strip():
+                    yield line.strip()
+    else:
+        yield from Path(midis_path).glob(midis_glob)
+
+
+def read_midi(midi_path):
+    """Reads the raw bytes of a MIDI file, or None if it can't be read."""
+    try:
+        return Path(midi_path).read_bytes()
+    except OSError:
+        return None
+
+
+def prefetch_midis(midi_paths):
+    """Yields the bytes of each MIDI file, in order, reading the next ones in the background.
+
+    File reads are I/O bound and release the GIL, so disk or network latency overlaps
+    with the parsing of the files already read. At most `READ_AHEAD` files are held in
+    memory ahead of the consumer.
+    """
+    with ThreadPoolExecutor(max_workers=READ_THREADS) as executor:
+        pending = deque()
+
+        for midi_path in midi_paths:
+            if len(pending) >= READ_AHEAD:
+                yield pending.popleft().result()
+
+            pending.append(executor.submit(read_midi, midi_path))
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def load_score(midi_path, midi_data=None):
+    """Parses a MIDI from its already read bytes, if given, or from its path."""
+    if midi_data is not None:
+        return Score.from_midi(midi_data)
+
+    return Score(str(midi_path))
+
+
+def parse_classes(classes):
+    """Parses a comma separated list of instrument classes (e.g. 1,14,16)."""
+    if classes is None:
+        return None
+
+    return [int(c.strip()) for c in classes.strip().split(',')]
+
+
+def get_keep_programs(classes=None):
+    """Returns the set of programs surviving the cleanup.
+
+    It only depends on the requested classes, so it is computed once per run
+    rather than once per MIDI file.
+    """
+    if classes is None:
+        programs_to_delete = EFFECTS_PROGRAMS
+    else:
+        programs_to_delete = get_other_programs(classes)
+
+    return filter_programs(programs_to_delete)
+
+
+def get_valid_programs(keep_programs, drum_programs, classes=None):
+    """Returns the programs kept from a MIDI, given the drum programs it uses."""
+    # some drum tracks use non-standard programs
+    if classes != None and 16 in classes and len(drum_programs) > 0:
+        return keep_programs | set(drum_programs)
+
+    return keep_programs
+
+
+def clean_score(midi_score, valid_programs, classes=None):
+    """Removes the unwanted tracks of a score and merges its instrument classes, in place."""
+    # remove unwanted tracks
+    merge_tracks_per_class(midi_score, valid_programs=valid_programs)
+
+    if len(midi_score.tracks) >= 1 and classes is None:
+        # merge percussion/drums, synths, strings and guitar & bass
+        # in a single pass over the tracks
+        merge_tracks_per_class(midi_score, CLASSES_MERGED)
+
+    return midi_score
+
+
 def parse_bpe_tokens(tokenizer, tokens):
-    seq = [next(key for key, value in tokenizer.vocab_bpe.items() if value == tid)
-           for tid in tokens]
-    tseq = [tokenizer._vocab_bpe_bytes_to_tokens[bpetoken] for bpetoken in seq]
+    # invert the vocab once instead of scanning it for every token
+    vocab_model_ids = {value: key for key, value in tokenizer.vocab_model.items()}
+    seq = [vocab_model_ids[tid] for tid in tokens]
+    tseq = [tokenizer._vocab_learned_bytes_to_tokens[bpetoken]
+            for bpetoken in seq]
 
     return list(chain.from_iterable(tseq))
 
 
+def restore_vocab_bytes(tokenizer):
+    """Rebuilds the base vocab to bytes mappings used by BPE.
+
+    miditok leaves them empty when loading the params of a tokenizer that has not
+    been trained yet, making `_ids_to_bytes` and `learn_bpe` fail.
+    """
+    if len(tokenizer._vocab_base_id_to_byte) == 0:
+        vocab = tokenizer.vocab.items()
+        tokenizer._vocab_base_id_to_byte = {
+            i: chr(i + CHR_ID_START) for _, i in vocab}
+        tokenizer._vocab_base_byte_to_token = {
+            chr(i + CHR_ID_START): tok for tok, i in vocab}
+
+
 def get_tokenizer(params=None, algo='MMM', programs=None):
     """Returns a tokenizer.
 
@@ -295,38 +407,39 @@ def get_tokenizer(params=None, algo='MMM', programs=None):
         tokenizer = MMM(density_bins_max=(10, 20), tokenizer_config=TokenizerConfig(
             **TOKENIZER_PARAMS), params=params)
 
+    if params != None:
+        restore_vocab_bytes(tokenizer)
+
     logger.info(
         'Tokenizer initialized. Using {algo} ({size})', algo=algo, size=len(tokenizer))
 
     return tokenizer
 
 
-@deco
-def process_midi(midi_path, pba: ActorHandle, classes=None, classes_req=None, minlength=16, debug=False):
+def process_midi(midi_path, keep_programs, classes=None, classes_req=None, minlength=16, tokens_path=None,
+                 tokenizer=None, midi_data=None):
+    """Pre-process a MIDI file and returns its document.
+
+    When a tokenizer is given, the MIDI is also tokenized right away from the score
+    already in memory, sparing a second parse in a separate tokenization pass.
+    """
     midi_doc = None
     midi_score = None
-    midi = None
 
     try:
-        midi = MidiFile(midi_path)
-    except Exception as err:
-        midi = None
-
-    try:
-        midi_score = Score().from_file(midi_path)
+        midi_score = load_score(midi_path, midi_data)
     except Exception as err:
         midi_score = None
 
-    if midi is not None and midi_score is not None:
+    if midi_score is not None:
         try:
-            required_ticks = max(BEAT_RES.values()) * 4
-            length_in_beats = midi.max_tick / midi.ticks_per_beat
+            length_in_beats = midi_score.end() / midi_score.ticks_per_quarter
             has_req_length = not (
-                length_in_beats < minlength or midi.ticks_per_beat < required_ticks)
+                length_in_beats < minlength or midi_score.ticks_per_quarter < REQUIRED_TICKS)
 
             if has_req_length:
                 programs = get_score_programs(midi_score)
-                midi_programs = list(set([p[0] for p in programs]))
+                midi_programs = set([p[0] for p in programs])
                 drum_programs = list(
                     set([p[0] for p in programs if p[1] == True]))
 
@@ -334,66 +447,25 @@ def process_midi(midi_path, pba: ActorHandle, classes=None, classes_req=None, mi
                 meets_req = True
 
                 if classes_req != None:
-                    classes_req = classes_req.strip().split(',')
-                    classes_req = [int(c.strip()) for c in classes_req]
-
                     for ic in classes_req:
-                        class_programs = list(
-                            INSTRUMENT_CLASSES[ic]['program_range'])
-                        intersect = list(set(midi_programs) &
-                                         set(class_programs))
                         meets_req = (ic == 16 and len(drum_programs) > 0) \
-                            or meets_req and len(intersect) > 0
+                            or meets_req and not CLASS_PROGRAMS[ic].isdisjoint(midi_programs)
 
                         if not meets_req:
                             break
 
                 if meets_req:
-                    # remove unwanted tracks
-                    programs_to_delete = []
-
-                    if classes is None:
-                        for ic in CLASS_EFFECTS:
-                            programs_to_delete += list(
-                                INSTRUMENT_CLASSES[ic]['program_range'])
-                    else:
-                        classes = classes.strip().split(',')
-                        classes = [int(c.strip()) for c in classes]
-                        programs_to_delete = get_other_programs(classes)
-
-                    keep_programs = filter_programs(programs_to_delete)
-
-                    # some drum tracks use non-standard programs
-                    if classes != None and 16 in classes \
-                            and len(drum_programs) > 0:
-                        keep_programs = list(
-                            set(keep_programs + drum_programs))
-
-                    # remove unwanted tracks
-                    merge_tracks_per_class(
-                        midi_score, valid_programs=keep_programs)
+                    valid_programs = get_valid_programs(
+                        keep_programs, drum_programs, classes=classes)
 
-                    # discard empty songs
-                    if len(midi.instruments) >= 1:
-                        if classes is None:
-                            # merge percussion/drums
-                            merge_tracks_per_class(
-                                midi_score, CLASSES_PERCUSSION)
+                    clean_score(midi_score, valid_programs, classes=classes)
 
-                            # merge synths
-                            merge_tracks_per_class(midi_score, CLASSES_SYNTHS)
-
-                            # merge strings
-                            merge_tracks_per_class(midi_score, CLASSES_STRINGS)
-
-                            # merge guitar & bass
-                            merge_tracks_per_class(
-                                midi_score, CLASSES_GUITAR_BASS)
-
-                        # merge_same_program_tracks(midi.instruments)
+                    # discard empty songs
+                    if len(midi_score.tracks) >= 1:
+                        # merge_same_program_tracks(midi_score.tracks)
 
-                        midi_name = re.sub(r'[^0-9a-z_]{1,}', '_',
-                                           str.lower(os.path.basename(midi_path)))
+                        midi_name = MIDI_NAME_RE.sub(
+                            '_', str.lower(os.path.basename(midi_path)))
 
                         programs = list(set([program[0]
                                         for program in get_score_programs(midi_score)]))
@@ -403,144 +475,293 @@ def process_midi(midi_path, pba: ActorHandle, classes=None, classes_req=None, mi
                             'path': midi_path,
                             'name': midi_name
                         }
+
+                        if tokenizer is not None and tokenize_score(
+                                midi_score, midi_doc, tokens_path, tokenizer) is None:
+                            midi_doc = None
         except Exception as err:
             pass
 
-    if pba != None:
-        pba.update.remote(1)
-
     return midi_doc
 
 
 @deco
-def tokenize_set(midi_doc, tokens_path, tokenizer, pba: ActorHandle, bpe=False, debug=False):
-    midi = None
+def process_midis(midi_paths, keep_programs, classes=None, classes_req=None, minlength=16, tokens_path=None,
+                  tokenizer=None, debug=False):
+    """Pre-process a chunk of MIDI files within a single task."""
+    midi_docs = [process_midi(midi_path, keep_programs, classes=classes, classes_req=classes_req, minlength=minlength,
+                              tokens_path=tokens_path, tokenizer=tokenizer, midi_data=midi_data)
+                 for midi_path, midi_data in zip(midi_paths, prefetch_midis(midi_paths))]
+
+    return [midi_doc for midi_doc in midi_docs if midi_doc != None]
+
+
+def save_tokens(tokens, path, programs=None):
+    """Saves the tokens returned by `encode` with the layout of `MusicTokenizer.save_tokens`.
+
+    Unlike miditok, sequences without ids are not completed first; `encode` always sets them.
+    """
+    if isinstance(tokens, TokSequence):
+        ids = tokens.ids
+        ids_encoded = tokens.are_ids_encoded
+    else:
+        ids = [seq.ids for seq in tokens]
+        ids_encoded = [seq.are_ids_encoded for seq in tokens]
+
+    tokens_cfg = {'ids': ids, 'ids_encoded': ids_encoded}
+
+    if programs is not None:
+        tokens_cfg['programs'] = programs
+
+    save_json(tokens_cfg, path)
+
+
+def tokenize_score(midi_score, midi_doc, tokens_path, tokenizer):
+    """Tokenizes the cleaned score of a MIDI document and saves the tokens to disk."""
+    tokens_cfg = f"{tokens_path}/{midi_doc['name']}.json"
+    programs = midi_doc['programs']
+
+    try:
+        tokens = tokenizer.encode(midi_score)
+        save_tokens(tokens, tokens_cfg, programs=programs)
+    except Exception as error:
+        print(error)
+        tokens_cfg = None
+
+    return tokens_cfg
+
+
+def tokenize_set(midi_doc, tokens_path, tokenizer, keep_programs, classes=None, midi_data=None):
+    midi_file = None
     tokens_cfg = None
 
     try:
-        midi = MidiFile(midi_doc['path'])
+        midi_file = load_score(midi_doc['path'], midi_data)
     except:
         pass
 
-    if midi is not None:
-        midi_file = Score().from_file(midi_doc['path'])
-        tokens_cfg = f"{tokens_path}/{midi_doc['name']}.json"
-        programs = midi_doc['programs']
+    if midi_file is not None:
+        # repeat the cleanup of the collection pass, which only kept the document
+        drum_programs = list(
+            set([p[0] for p in get_score_programs(midi_file) if p[1] == True]))
+        valid_programs = get_valid_programs(
+            keep_programs, drum_programs, classes=classes)
+
+        clean_score(midi_file, valid_programs, classes=classes)
+
+        tokens_cfg = tokenize_score(midi_file, midi_doc, tokens_path, tokenizer)
+        del midi_file
+
+    return tokens_cfg
+
+
+@deco
+def tokenize_sets(midi_docs, tokens_path, tokenizer, keep_programs, classes=None, bpe=False, debug=False):
+    """Tokenizes a chunk of MIDI documents within a single task.
+
+    The tokenizer is deserialized once per chunk instead of once per MIDI.
+    """
+    midi_datas = prefetch_midis([midi_doc['path'] for midi_doc in midi_docs])
+    tokens_cfgs = [tokenize_set(midi_doc, tokens_path, tokenizer, keep_programs, classes=classes,
+                                midi_data=midi_data)
+                   for midi_doc, midi_data in zip(midi_docs, midi_datas)]
+
+    return tokens_cfgs
+
 
+@deco
+def load_bpe_docs(tokens_paths, tokenizer, debug=False):
+    """Loads a chunk of token files as BPE documents.
+
+    Each document keeps the name and programs of its file along with the ids and the
+    bytes string of each of its token sequences, so BPE can be learned and then applied
+    from memory, without reading the files again.
+    """
+    bpe_docs = []
+
+    for tokens_path in tokens_paths:
         try:
-            # remove unwanted tracks
-            merge_tracks_per_class(midi_file, valid_programs=programs)
+            sample = load_json(tokens_path)
+            ids = [sample['ids']] if tokenizer.one_token_stream else sample['ids']
+
+            bpe_docs.append({
+                'name': Path(tokens_path).name,
+                'programs': sample.get('programs'),
+                'ids': [np.asarray(track, dtype=np.int32) for track in ids],
+                'bytes': tokenizer._ids_to_bytes(ids, as_one_str=True)
+            })
+        except Exception as error:
+            logger.error('Could not load BPE documents from {path}: {error!r}',
+                         path=tokens_path, error=error)
+
+    return bpe_docs
 
-            tokens = tokenizer.encode(midi_file)
-            tokenizer.save_tokens(tokens, tokens_cfg, programs=programs)
+
+@deco
+def apply_bpe_set(bpe_docs, tokens_bpe_path, tokenizer, debug=False):
+    """Applies BPE to a chunk of BPE documents, saving their tokens into `tokens_bpe_path`."""
+    tokens_cfgs = []
+
+    for bpe_doc in bpe_docs:
+        tokens_cfg = f"{tokens_bpe_path}/{bpe_doc['name']}"
+
+        try:
+            # the bytes are already known, encoding only has to split and merge them
+            seq = [TokSequence(ids=ids.tolist(), bytes=bytes_)
+                   for ids, bytes_ in zip(bpe_doc['ids'], bpe_doc['bytes'])]
+
+            tokenizer.encode_token_ids(seq)
+            save_tokens(seq[0] if tokenizer.one_token_stream else seq,
+                        tokens_cfg, programs=bpe_doc['programs'])
         except Exception as error:
-            print(error)
+            logger.error('Could not apply BPE to {name}: {error!r}',
+                         name=bpe_doc['name'], error=error)
             tokens_cfg = None
-        finally:
-            del midi
-            del midi_file
 
-    if not debug:
-        pba.update.remote(1)
+        tokens_cfgs.append(tokens_cfg)
 
-    return tokens_cfg
+    return tokens_cfgs
 
 
-def get_collection_refs(midis_path=None, midis_glob=None, classes=None, classes_req=None, minlength=16, debug=False, num_limit=None):
-    """Pre-process and retrieves a collection of MIDI files, ready for tokenization."""
-    if os.path.isfile(midis_path):
-        midi_file_paths = [line.strip()
-                           for line in open(midis_path) if line.strip()]
-    else:
-        midi_file_paths = list(Path(midis_path).glob(midis_glob))
+@deco
+def load_token_ids(tokens_paths, dtype=np.uint16, debug=False):
+    """Loads the ids of a chunk of token files as arrays (first track, as MIDIDataset does)."""
+    token_ids = []
+
+    for tokens_path in tokens_paths:
+        try:
+            ids = load_json(tokens_path)['ids']
+            token_ids.append(np.asarray(
+                ids[0] if isinstance(ids[0], list) else ids, dtype=dtype))
+        except Exception as error:
+            print(error)
+
+    return token_ids
+
+
+def save_binidx(tokens_paths, binidx_path, vocab_size=None, workers=1, debug=False):
+    """Exports a set of token files as a single binidx dataset, one document per file.
+
+    This is an extra output for the trainer, the JSON files remain the format every
+    tokenization stage reads and writes.
+
+    Ids are kept in the narrowest dtype fitting `vocab_size` from the moment they are
+    loaded. The resulting `binidx_path` prefix can be fed to the trainer with `--binidx`.
+    """
+    # binidx depends on torch, only import it when a dataset is requested
+    from binidx import MMapIndexedDataset, best_fitting_dtype, data_file_path, index_file_path
+
+    dtype = best_fitting_dtype(vocab_size)
+    load_call = load_token_ids if debug else load_token_ids.remote
+    tokens_chunks = tqdm(get_chunks(tokens_paths, workers), desc='Saving binidx', unit='chunk', mininterval=1.0)
+    ray_refs = (load_call(tokens_chunk, dtype=dtype, debug=debug)
+                for tokens_chunk in tokens_chunks)
+    sizes = []
+
+    with open(data_file_path(binidx_path), 'wb') as bin_file:
+        for token_ids in to_bounded_iterator(ray_refs, max(1, workers) * PENDING_PER_WORKER, debug=debug):
+            for ids in token_ids:
+                bin_file.write(ids.tobytes(order='C'))
+                sizes.append(len(ids))
+
+    with MMapIndexedDataset.Index.writer(index_file_path(binidx_path), dtype) as index:
+        index.write(sizes, list(range(len(sizes) + 1)))
+
+    return sum(sizes)
+
+
+def get_collection(midis_path=None, midis_glob=None, classes=None, classes_req=None, minlength=16, debug=False,
+                   num_limit=None, workers=1, tokens_path=None, tokenizer=None):
+    """Pre-process and retrieves a collection of MIDI documents, ready for tokenization.
+
+    Files are dispatched in chunks so each task amortizes its scheduling overhead over
+    several MIDIs. Only a few chunks per worker are in flight at any time, and their
+    documents are collected as they complete. If a tokenizer is given, tokens are saved
+    to `tokens_path` as each MIDI gets processed.
+
+    Unless a random selection is requested, paths are streamed as they are found so
+    processing starts before the whole tree has been walked.
+    """
+    midi_file_paths = iter_midi_paths(midis_path, midis_glob)
 
     # Add random sampling with num_limit
     if num_limit is not None and num_limit > 0:
+        midi_file_paths = list(midi_file_paths)
         random.shuffle(midi_file_paths)  # Randomize order
         midi_file_paths = midi_file_paths[:num_limit]  # Take first N
-
-    logger.info('Processing collection: {coll_size} MIDI files',
-                coll_size=len(midi_file_paths))    # process MIDIs via Ray
-    if not debug:
-        pb = ProgressBar(len(midi_file_paths))
-        actor = pb.actor
+        midi_chunks = get_chunks(midi_file_paths, workers)
     else:
-        actor = None
-        midi_file_paths = tqdm(midi_file_paths)
+        midi_chunks = iter_chunks(midi_file_paths)
 
-    process_call = process_midi.remote if not debug else process_midi
-    ray_refs = [process_call(midi_path, actor, classes=classes, classes_req=classes_req, minlength=minlength, debug=debug)
-                for midi_path in midi_file_paths]
+    classes = parse_classes(classes)
+    classes_req = parse_classes(classes_req)
+    keep_programs = get_keep_programs(classes)
 
-    if not debug:
-        pb.print_until_done()
+    # process MIDIs via Ray
+    process_call = process_midis.remote if not debug else process_midis
+    ray_refs = (process_call(midi_chunk, keep_programs, classes=classes, classes_req=classes_req,
+                             minlength=minlength, tokens_path=tokens_path, tokenizer=tokenizer, debug=debug)
+                for midi_chunk in tqdm(midi_chunks, desc='Processing collection', unit='chunk', mininterval=1.0))
+    midi_collection = list(chain.from_iterable(
+        to_bounded_iterator(ray_refs, max(1, workers) * PENDING_PER_WORKER, debug=debug)))
 
-    return [ref for ref in ray_refs if ref != None]
+    logger.info('Processed collection: {coll_size} MIDI documents',
+                coll_size=len(midi_collection))
+
+    return midi_collection
 
 
 # begin program
 if __name__ == "__main__":
-    MIDI_TITLES = []
-    MIDI_PROGRAMS = []
-
     if not args.debug:
         # starts orchestration
-        # ray.init(num_cpus=psutil.cpu_count())
-        ray.init(num_cpus=4)
-
-        MIDI_COLLECTION_REFS = get_collection_refs(
-            args.midis_path, args.midis_glob, args.classes, args.classes_req,
-            args.length, debug=False, num_limit=args.num_limit)
-
-        for ray_midi_ref in MIDI_COLLECTION_REFS:
-            midi_doc = ray.get(ray_midi_ref)
-
-            if midi_doc != None:
-                MIDI_TITLES.append(midi_doc['name'])
-                MIDI_PROGRAMS.append(midi_doc['programs'])
-    else:
-        MIDI_COLLECTION_REFS = get_collection_refs(
-            args.midis_path, args.midis_glob, args.classes, args.classes_req,
-            args.length, debug=args.debug, num_limit=args.num_limit)
-        MIDI_TITLES = [midi_ref['name'] for midi_ref in MIDI_COLLECTION_REFS]
-        MIDI_PROGRAMS = [midi_ref['programs']
-                         for midi_ref in MIDI_COLLECTION_REFS]
-
-    logger.info('Processing tokenization: {collection_size} documents', collection_size=len(
-        MIDI_COLLECTION_REFS))
+        ray.init(num_cpus=args.workers)
 
     Path(args.tokens_path).mkdir(parents=True, exist_ok=True)
 
-    # collect used programs
-    programs_used = [program for program in list(
-        set(reduce(iconcat, MIDI_PROGRAMS, [])))]
-
     # initializes tokenizer
     params_path = os.path.join(args.tokens_path, args.preload)
     preloads = Path(params_path).is_file()
+    TOKENIZER = None
 
     if preloads:
+        # tokens can be saved while the collection gets processed
         logger.info('Preloading params from {path}', path=params_path)
-
-    TOKENIZER = get_tokenizer(
-        programs=programs_used, algo=args.algo) if not preloads else get_tokenizer(params=params_path)
-
-    # process tokenization via Ray
-    if not args.debug:
-        pb = ProgressBar(len(MIDI_COLLECTION_REFS))
-        actor = pb.actor
-        midi_collection_refs = MIDI_COLLECTION_REFS
+        TOKENIZER = get_tokenizer(params=params_path)
+
+    # share a single copy of the tokenizer with all Ray workers
+    MIDI_COLLECTION = get_collection(
+        args.midis_path, args.midis_glob, args.classes, args.classes_req,
+        args.length, debug=args.debug, num_limit=args.num_limit, workers=args.workers,
+        tokens_path=args.tokens_path,
+        tokenizer=ray.put(TOKENIZER) if preloads and not args.debug else TOKENIZER)
+    MIDI_TITLES = [midi_doc['name'] for midi_doc in MIDI_COLLECTION]
+    MIDI_PROGRAMS = [midi_doc['programs'] for midi_doc in MIDI_COLLECTION]
+
+    if not preloads:
+        logger.info('Processing tokenization: {collection_size} documents', collection_size=len(
+            MIDI_COLLECTION))
+
+        # collect used programs
+        programs_used = [program for program in list(
+            set(reduce(iconcat, MIDI_PROGRAMS, [])))]
+
+        TOKENIZER = get_tokenizer(programs=programs_used, algo=args.algo)
+
+        # process tokenization via Ray
+        midi_chunks = get_chunks(MIDI_COLLECTION, args.workers)
+        tokenizer_ref = ray.put(TOKENIZER) if not args.debug else TOKENIZER
+        classes = parse_classes(args.classes)
+        keep_programs = get_keep_programs(classes)
+        tokenize_call = tokenize_sets if args.debug else tokenize_sets.remote
+        ray_tokenized_refs = (tokenize_call(midi_chunk, args.tokens_path, tokenizer_ref, keep_programs,
+                                            classes=classes, bpe=args.bpe, debug=args.debug)
+                              for midi_chunk in tqdm(midi_chunks, desc='Tokenizing', unit='chunk', mininterval=1.0))
+        TOKENS_CFGS = list(chain.from_iterable(to_bounded_iterator(
+            ray_tokenized_refs, args.workers * PENDING_PER_WORKER, debug=args.debug)))
     else:
-        actor = None
-        midi_collection_refs = tqdm(MIDI_COLLECTION_REFS)
-
-    tokenize_call = tokenize_set if args.debug else tokenize_set.remote
-    ray_tokenized_refs = [tokenize_call(ray_midi_ref, args.tokens_path, TOKENIZER,
-                                        actor, bpe=args.bpe, debug=args.debug) for ray_midi_ref in midi_collection_refs]
-
-    if not args.debug:
-        pb.print_until_done()
-        ray.shutdown()
+        logger.info('Tokenized {collection_size} documents', collection_size=len(
+            MIDI_COLLECTION))
 
     logger.info('Vocab size (base): {vocab_size}',
                 vocab_size=len(TOKENIZER.vocab))
@@ -561,17 +782,45 @@ if __name__ == "__main__":
         TOKENIZER = get_tokenizer(
             params=f'{args.tokens_path}/{TOKEN_PARAMS_NAME}', algo=args.algo)
 
+        # load the corpora once, in parallel, so BPE learns and gets applied from memory
+        tokens_chunks = get_chunks(token_files_paths, args.workers)
+        tokenizer_ref = ray.put(TOKENIZER) if not args.debug else TOKENIZER
+        load_call = load_bpe_docs if args.debug else load_bpe_docs.remote
+        bpe_docs_refs = (load_call(tokens_chunk, tokenizer_ref, debug=args.debug)
+                         for tokens_chunk in tqdm(tokens_chunks, desc='Loading tokens', unit='chunk', mininterval=1.0))
+        BPE_DOCS = list(chain.from_iterable(to_bounded_iterator(
+            bpe_docs_refs, args.workers * PENDING_PER_WORKER, debug=args.debug)))
+
+        # one sample per token sequence, holding its bytes string
+        bpe_samples = [[bytes_]
+                       for bpe_doc in BPE_DOCS for bytes_ in bpe_doc['bytes']]
+
         logger.info('Learning BPE from vocab size {vocab_size}...', vocab_size=len(
             TOKENIZER))
 
+        # the Rust BPE trainer is multi-threaded, let it use every core
+        # unless the user chose otherwise
+        if not TOKENIZERS_PARALLELISM_SET:
+            os.environ['TOKENIZERS_PARALLELISM'] = 'true'
+
         TOKENIZER.learn_bpe(
             vocab_size=int(len(TOKENIZER.vocab)*1.25),
-            files_paths=[path for path in token_files_paths if path != None],
+            iterator=bpe_samples,
             start_from_empty_voc=False,
         )
 
+        del bpe_samples
+
         logger.info('Applying BPE...')
-        TOKENIZER.apply_bpe_to_dataset(args.tokens_path, tokens_bpe_path)
+        bpe_chunks = get_chunks(BPE_DOCS, args.workers)
+        tokenizer_ref = ray.put(TOKENIZER) if not args.debug else TOKENIZER
+        apply_call = apply_bpe_set if args.debug else apply_bpe_set.remote
+        ray_bpe_refs = (apply_call(bpe_chunk, tokens_bpe_path, tokenizer_ref, debug=args.debug)
+                        for bpe_chunk in tqdm(bpe_chunks, desc='Applying BPE', unit='chunk', mininterval=1.0))
+        TOKENS_BPE_CFGS = list(chain.from_iterable(to_bounded_iterator(
+            ray_bpe_refs, args.workers * PENDING_PER_WORKER, debug=args.debug)))
+
+        del BPE_DOCS, bpe_chunks
 
         logger.info('Saving params with BPE applied...')
         TOKENIZER.save_params(f'{tokens_bpe_path}/{TOKEN_PARAMS_NAME}')
@@ -579,4 +828,15 @@ if __name__ == "__main__":
         logger.info('Vocab size (BPE): {vocab_size}',
                     vocab_size=len(TOKENIZER))
 
+    if args.binidx:
+        tokens_out_path = tokens_bpe_path if args.bpe else args.tokens_path
+        binidx_path = f'{tokens_out_path}/{BINIDX_NAME}'
+
+        logger.info('Saving binidx dataset to {path}...', path=binidx_path)
+
+        num_tokens = save_binidx(list(Path(tokens_out_path).glob('*.json')), binidx_path,
+                                 vocab_size=len(TOKENIZER), workers=args.workers, debug=args.debug)
+
+        logger.info('Saved {num_tokens} tokens', num_tokens=num_tokens)
+
     ray.shutdown()